@@ -1,18 +1,27 @@
 # -*- coding: utf-8 -*-
 import os
-import json
+import re
 import types
+import functools
+import hashlib
+import io
+import queue
+import atexit
+import threading
 from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, List, Dict, Any, Iterator
 
 import gradio as gr
+import orjson
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 
-from tencentcloud.common import credential
-from tencentcloud.common.profile.client_profile import ClientProfile
-from tencentcloud.common.profile.http_profile import HttpProfile
-from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
-from tencentcloud.hunyuan.v20230901 import hunyuan_client, models
+# tencentcloud SDK 依赖较重，延迟到首次使用时再导入，加快启动
+if TYPE_CHECKING:
+    from tencentcloud.hunyuan.v20230901 import models
 
 
 # ===================== 基本配置（可按需修改） =====================
@@ -22,6 +31,9 @@ default_models = ["hunyuan-a13b", "hunyuan-standard", "hunyuan-pro"]
 log_dir = "logs"                 # 日志保存目录
 default_temperature = 0.7
 default_max_tokens = 512
+default_max_turns = 8            # 滑动窗口：保留最近 N 轮 user/assistant（system 不计）
+concurrency_limit = 16           # 同时处理的请求数（Gradio 默认每个事件仅 1 个）
+persona_cache_key = "mtime"      # 人设缓存键："mtime"，或 "sha256"（网络文件系统上 mtime 不可靠时）
 
 
 # ===================== 工具函数 =====================
@@ -35,25 +47,154 @@ def load_models_from_file(path: str | Path) -> List[str]:
     if not p.exists():
         return default_models
     try:
-        data = json.loads(p.read_text(encoding="utf-8"))
+        data = orjson.loads(p.read_bytes())
         if isinstance(data, list) and all(isinstance(x, str) for x in data):
             return data
     except Exception:
         pass
     return default_models
 
+def _walk_xml(root: str) -> Iterator[str]:
+    """基于 os.scandir 的递归遍历，yield 相对 root 的 .xml 路径（DirEntry 自带类型缓存）。"""
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".xml"):
+                        yield os.path.relpath(entry.path, root)
+        except OSError:
+            continue
+
 def scan_personas(dirpath: str | Path) -> List[str]:
-    p = Path(dirpath)
-    if not p.exists():
+    root = os.fspath(dirpath)
+    if not os.path.isdir(root):
         return []
     # 返回相对 prompts_dir 的路径，支持子目录
-    return [str(x.relative_to(p)) for x in p.glob("**/*.xml")]
+    return list(_walk_xml(root))
+
+# 人设列表的内存缓存：由 watchdog 文件事件增量维护，刷新时无需重新扫描
+_persona_cache: list[str] | None = None
+_persona_lock = threading.Lock()
+_persona_observer = None
+
+class _PersonaWatcher(FileSystemEventHandler):
+    def __init__(self, root: str):
+        super().__init__()
+        self.root = root
+
+    def _rescan(self):
+        files = scan_personas(self.root)
+        with _persona_lock:
+            # 初始扫描完成前的事件无需处理，初始扫描会覆盖
+            if _persona_cache is not None:
+                _persona_cache[:] = files
+
+    def _add(self, path: str):
+        if path.endswith(".xml"):
+            rel = os.path.relpath(path, self.root)
+            with _persona_lock:
+                if _persona_cache is not None and rel not in _persona_cache:
+                    _persona_cache.append(rel)
+
+    def _remove(self, path: str):
+        rel = os.path.relpath(path, self.root)
+        with _persona_lock:
+            if _persona_cache is not None and rel in _persona_cache:
+                _persona_cache.remove(rel)
+
+    def on_created(self, event):
+        if event.is_directory:
+            self._rescan()
+        else:
+            self._add(event.src_path)
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            self._rescan()
+        else:
+            self._remove(event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            self._rescan()
+        else:
+            self._remove(event.src_path)
+            self._add(event.dest_path)
+
+def watch_personas(dirpath: str | Path) -> None:
+    """
+    监听 dirpath 的变化并扫描一次，之后由文件事件维护人设列表。
+    监听启动失败（如 inotify 数量达到上限）时不影响启动，回退为每次现场扫描。
+    """
+    global _persona_cache, _persona_observer
+    root = os.fspath(dirpath)
+    try:
+        observer = Observer()
+        observer.schedule(_PersonaWatcher(root), root, recursive=True)
+        observer.daemon = True
+        observer.start()
+    except OSError as e:
+        print(f"[Warn] 无法监听 {root}，人设列表改为每次扫描：{e}")
+        return
+    _persona_observer = observer
+    # 先启动监听再扫描，避免漏掉两者之间的变化
+    files = scan_personas(root)
+    with _persona_lock:
+        _persona_cache = files
+
+def list_personas() -> List[str]:
+    """
+    返回 prompts_dir 下的人设列表：监听线程存活时直接读缓存（O(1)）；
+    未启动或监听线程已退出时现场扫描，并顺带刷新缓存。
+    """
+    observer_alive = _persona_observer is not None and _persona_observer.is_alive()
+    with _persona_lock:
+        if observer_alive and _persona_cache is not None:
+            return list(_persona_cache)
+    files = scan_personas(prompts_dir)
+    with _persona_lock:
+        if _persona_cache is not None:
+            _persona_cache[:] = files
+    return files
+
+@functools.lru_cache(maxsize=128)
+def _read_cached(path: str, key: int | str) -> str:
+    # key（mtime 或内容哈希）参与缓存键：文件被修改后自动失效
+    return Path(path).read_text(encoding="utf-8")
+
+def _content_key(path: str | Path) -> str:
+    """文件内容的 SHA-256（走 OpenSSL，支持时自动使用 SHA 硬件指令）。"""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for block in iter(lambda: f.read(65536), b""):
+            h.update(block)
+        return h.hexdigest()
+
+def _persona_key(full: Path) -> int | str:
+    if persona_cache_key == "sha256":
+        return _content_key(full)
+    return full.stat().st_mtime_ns
 
 def load_system_xml(full_path: str | Path) -> str:
-    p = Path(full_path)
-    if not p.exists():
-        raise FileNotFoundError(f"System XML not found: {p.resolve()}")
-    return p.read_text(encoding="utf-8")
+    return _read_persona(Path(full_path))[1]
+
+def _read_persona(full: Path) -> tuple[int | str, str]:
+    """返回 (缓存键, 内容)。缺失时由 stat/open 抛错，省去额外的 exists() 检查。"""
+    try:
+        key = _persona_key(full)
+        return key, _read_cached(str(full), key)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"System XML not found: {full.resolve()}") from None
+
+# 合并后的 system 文本按人设组合共享：多个会话选同一组人设时引用同一个 str 对象，
+# 而不是各存一份副本。值为 (各文件缓存键, 合并文本)，任一文件变化即重新合并并替换。
+_system_intern: dict[tuple[str, tuple[str, ...]], tuple[tuple, str]] = {}
 
 def merge_personas(rel_paths: list[str] | None, base_dir: str | Path) -> str:
     """
@@ -63,22 +204,34 @@ def merge_personas(rel_paths: list[str] | None, base_dir: str | Path) -> str:
     """
     if not rel_paths:
         return ""
-    parts = []
-    for rel in rel_paths:
-        full = Path(base_dir, rel)
-        if not full.exists():
-            raise FileNotFoundError(f"System XML not found: {full.resolve()}")
-        xml = full.read_text(encoding="utf-8")
-        parts.append(f"<!-- BEGIN: {rel} -->\n{xml}\n<!-- END: {rel} -->")
+    # 并发读取（ex.map 保持传入顺序）
+    with ThreadPoolExecutor(max_workers=min(8, len(rel_paths))) as ex:
+        loaded = list(ex.map(lambda rel: _read_persona(Path(base_dir, rel)), rel_paths))
+    intern_key = (os.fspath(base_dir), tuple(rel_paths))
+    file_keys = tuple(key for key, _ in loaded)
+    cached = _system_intern.get(intern_key)
+    if cached is not None and cached[0] == file_keys:
+        return cached[1]
+    parts = [
+        f"<!-- BEGIN: {rel} -->\n{xml}\n<!-- END: {rel} -->"
+        for rel, (_, xml) in zip(rel_paths, loaded)
+    ]
     header = (
         "<!--\n"
         "  Multiple persona XML merged.\n"
         "  NOTE: Later files override earlier ones when rules conflict.\n"
         "-->\n"
     )
-    return header + "\n\n".join(parts)
+    merged = header + "\n\n".join(parts)
+    _system_intern[intern_key] = (file_keys, merged)
+    return merged
 
 def make_client():
+    from tencentcloud.common import credential
+    from tencentcloud.common.profile.client_profile import ClientProfile
+    from tencentcloud.common.profile.http_profile import HttpProfile
+    from tencentcloud.hunyuan.v20230901 import hunyuan_client
+
     # 需要环境变量：TENCENTCLOUD_SECRET_ID / TENCENTCLOUD_SECRET_KEY
     cred = credential.Credential(
         os.getenv("TENCENTCLOUD_SECRET_ID"),
@@ -86,200 +239,396 @@ def make_client():
     )
     http_profile = HttpProfile()
     http_profile.endpoint = "hunyuan.tencentcloudapi.com"
+    http_profile.keepAlive = True  # 复用 TCP/TLS 连接，省去每轮握手
+    # 连接池大小与并发数一致：流式回复整轮占用连接，池太小会丢弃多出的连接
+    http_profile.pre_conn_pool_size = concurrency_limit
     client_profile = ClientProfile()
     client_profile.httpProfile = http_profile
     return hunyuan_client.HunyuanClient(cred, "", client_profile)
 
+_shared_client = None
+_client_lock = threading.Lock()
+
+def get_shared_client():
+    """进程内所有会话共享同一个 client（及其连接池），首次调用时创建。"""
+    global _shared_client
+    with _client_lock:
+        if _shared_client is None:
+            _shared_client = make_client()
+        return _shared_client
+
+def _is_sdk_error(e: Exception) -> bool:
+    # SDK 延迟导入，处理异常时再取异常类型
+    from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
+    return isinstance(e, TencentCloudSDKException)
+
+def _to_message(msg: Dict[str, str]) -> "models.Message":
+    from tencentcloud.hunyuan.v20230901 import models
+
+    m = models.Message()
+    m.Role = msg["Role"]
+    m.Content = msg["Content"]
+    return m
+
 def call_hunyuan_chat(client, model_name: str, messages: List[Dict[str, str]],
-                      temperature: float, max_tokens: int) -> str:
+                      temperature: float, max_tokens: int,
+                      system_msg: "models.Message | None" = None,
+                      stream: bool = True) -> Iterator[str]:
+    """
+    流式调用 ChatCompletions，逐步 yield 截至目前的完整回复文本。
+    非流式响应只 yield 一次。
+    - system_msg：会话开始时预先构建好的 system 消息，每轮直接复用。
+    - stream：是否流式请求；不需要增量刷新的场景（如批量回放）可关闭。
+    """
+    from tencentcloud.hunyuan.v20230901 import models
+
+    # 直接填充请求字段，避免 json.dumps + from_json_string 的往返序列化
     req = models.ChatCompletionsRequest()
-    params = {
-        "Model": model_name,
-        "Messages": messages,
-        "Temperature": float(temperature),
-        "MaxTokens": int(max_tokens),
-        # "Stream": True,  # 若需要流式，可开启并改造UI回调
-    }
-    req.from_json_string(json.dumps(params, ensure_ascii=False))
+    req.Model = model_name
+    req.Messages = ([system_msg] if system_msg is not None else []) + [_to_message(m) for m in messages]
+    req.Temperature = float(temperature)
+    req.MaxTokens = int(max_tokens)
+    req.Stream = bool(stream)
     resp = client.ChatCompletions(req)
 
     # 兼容流式/非流式
     if isinstance(resp, types.GeneratorType):
         chunks = []
         for event in resp:
-            try:
-                data = json.loads(event["Data"])
-                delta = data.get("Choices", [{}])[0].get("Delta", {}).get("Content", "")
+            # SDK 的 SSE 事件为 {"id", "event", "data", ...}，键名小写；无 data 的事件（如心跳）跳过
+            if not event.get("data"):
+                continue
+            data = orjson.loads(event["data"])
+            delta = data.get("Choices", [{}])[0].get("Delta", {}).get("Content", "")
+            if delta:
                 chunks.append(delta)
-            except Exception:
-                pass
-        return "".join(chunks)
+                yield "".join(chunks)
     else:
-        data = json.loads(resp.to_json_string())
-        return data["Choices"][0]["Message"]["Content"]
-
-def format_dialogue_as_text(history: List[Dict[str, str]],
-                            model_name: str,
-                            persona_file: str | list[str] | None,
-                            started_at: datetime,
-                            ended_at: datetime) -> str:
+        # SDK 已把响应反序列化为模型对象，直接取字段，无需再经 JSON 往返
+        yield resp.Choices[0].Message.Content
+
+# 批量回放：要求模型按编号标签逐题作答
+_BATCH_INSTRUCTION = (
+    "<batch_format>\n"
+    "用户消息包含多个相互独立的问题，分别放在 <Q0>...</Q0>、<Q1>...</Q1> 等标签中。\n"
+    "请逐题作答，把第 i 题的回答放在 <Ai>...</Ai> 标签中（如 <A0>...</A0>），标签外不要输出其他内容。\n"
+    "</batch_format>"
+)
+_BATCH_ANSWER_RE = re.compile(r"<A(\d+)>(.*?)</A\1>", re.S)
+
+def batch_replay(client, prompts: List[str], system: str,
+                 model_name: str = default_models[0],
+                 temperature: float = default_temperature,
+                 max_tokens: int = default_max_tokens) -> List[str]:
+    """
+    离线批量回放：把多个相互独立的问题打包进一次请求，减少 API 调用次数。
+    - 仅适用于互不依赖的问题，不适用于多轮对话；
+    - 返回与 prompts 等长的回答列表，模型未按格式作答的题目为空字符串。
+    """
+    if not prompts:
+        return []
+    system_content = f"{system}\n\n{_BATCH_INSTRUCTION}" if system.strip() else _BATCH_INSTRUCTION
+    user_content = "\n".join(f"<Q{i}>{p}</Q{i}>" for i, p in enumerate(prompts))
+    messages = [
+        {"Role": "system", "Content": system_content},
+        {"Role": "user", "Content": user_content},
+    ]
+    # 离线场景无需增量刷新，用一次非流式请求取完整回复
+    reply = next(call_hunyuan_chat(client, model_name, messages, temperature, max_tokens, stream=False), "")
+    answers = {int(m.group(1)): m.group(2).strip() for m in _BATCH_ANSWER_RE.finditer(reply)}
+    return [answers.get(i, "") for i in range(len(prompts))]
+
+# 日志格式常量：提前构建，避免逐条消息重复拼接
+LOG_SEP = "-" * 28
+_LOG_ENTRY_FMT = "[{:03d}] Role: {}\n{}\n{}\n".format
+
+def format_log_header(model_name: str,
+                      persona_file: str | list[str] | None,
+                      started_at: datetime,
+                      ended_at: datetime) -> str:
     lines = []
     lines.append("=== Goblin Chat Log ===")
     lines.append(f"Model: {model_name}")
     if isinstance(persona_file, list):
         lines.append("PersonaXMLs:")
         for p in persona_file:
-            lines.append(f"  - {Path(prompts_dir, p).resolve()}")
+            lines.append(f"  - {os.path.abspath(os.path.join(prompts_dir, p))}")
     else:
-        lines.append(f"PersonaXML: {Path(prompts_dir, persona_file).resolve() if persona_file else 'None'}")
+        lines.append(f"PersonaXML: {os.path.abspath(os.path.join(prompts_dir, persona_file)) if persona_file else 'None'}")
     lines.append(f"StartedAt: {started_at.isoformat(timespec='seconds')}")
     lines.append(f"EndedAt:   {ended_at.isoformat(timespec='seconds')}")
     lines.append("=" * 28)
     lines.append("")
-    for i, msg in enumerate(history):
-        role = msg.get("Role", "unknown")
-        content = msg.get("Content", "")
-        lines.append(f"[{i:03d}] Role: {role}")
-        lines.append(content)
-        lines.append("-" * 28)
     return "\n".join(lines) + "\n"
 
-def save_dialogue(history: List[Dict[str, str]], model_name: str, persona_file: str | list[str] | None,
-                  started_at: datetime, ended_at: datetime) -> Path:
+def format_log_entry(idx: int, msg: Dict[str, str]) -> str:
+    return _LOG_ENTRY_FMT(idx, msg.get("Role", "unknown"), msg.get("Content", ""), LOG_SEP)
+
+# 日志写盘放到后台线程，避免阻塞 Gradio worker
+_log_q: "queue.Queue[tuple[Path, list[bytes], Future]]" = queue.Queue()
+
+def _write_chunks(fd: int, chunks: list[bytes]) -> None:
+    """scatter-gather 写入多段 bytes；无 os.writev（Windows）或部分写入时逐段补写。"""
+    written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if written >= len(view):
+            written -= len(view)
+            continue
+        view, written = view[written:], 0
+        while view:
+            view = view[os.write(fd, view):]
+
+def _writer_loop():
+    while True:
+        path, chunks, future = _log_q.get()
+        # 先写临时文件再 os.replace，保证同名文件被原子替换
+        tmp = path.with_name(path.name + ".tmp")
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+            try:
+                _write_chunks(fd, chunks)
+            finally:
+                os.close(fd)
+            os.replace(tmp, path)
+            future.set_result(path)
+        except Exception as e:
+            print(f"[Save Error] {path}: {e}")
+            tmp.unlink(missing_ok=True)
+            future.set_exception(e)
+        finally:
+            _log_q.task_done()
+
+_writer_started = False
+_writer_lock = threading.Lock()
+
+def _ensure_writer():
+    """首次保存时才启动写盘线程，import app 不产生副作用。"""
+    global _writer_started
+    with _writer_lock:
+        if not _writer_started:
+            threading.Thread(target=_writer_loop, name="log-writer", daemon=True).start()
+            # 进程退出前等待尚未写完的日志
+            atexit.register(_log_q.join)
+            _writer_started = True
+
+def save_dialogue(log_body: bytes, model_name: str, persona_file: str | list[str] | None,
+                  started_at: datetime, ended_at: datetime) -> tuple[Path, Future]:
+    """
+    log_body 为会话中增量累积、已编码为 UTF-8 的日志正文（见 append_log），这里只补上头部。
+    写盘由后台线程完成，立即返回 (目标路径, Future)；Future 在写盘完成或失败时结束。
+    """
     ensure_dir(log_dir)
     stamp = started_at.strftime("%Y%m%d_%H%M%S")
     fname = f"goblin_chat_{stamp}.txt"
     path = Path(log_dir) / fname
-    text = format_dialogue_as_text(history, model_name, persona_file, started_at, ended_at)
-    path.write_text(text, encoding="utf-8")
-    return path
+    header = format_log_header(model_name, persona_file, started_at, ended_at)
+    future = Future()
+    _ensure_writer()
+    _log_q.put((path, [header.encode("utf-8"), log_body], future))
+    return path, future
 
 
 # ===================== 会话状态与逻辑 =====================
+def new_history(max_turns: int, turns=()) -> deque:
+    """
+    滑动窗口历史：deque 的 maxlen 为 2*max_turns+1，追加时自动淘汰最旧的消息。
+    发送时总是 [最近 max_turns 轮 + 本轮 user]，首条必为 user。
+    """
+    keep = 2 * int(max_turns)
+    items = list(turns)
+    # 窗口满时首条可能是被截断轮次的 assistant；只保留末尾的完整轮次（偶数条）
+    items = items[len(items) % 2:]
+    return deque(items[-keep:], maxlen=keep + 1)
+
 def init_state() -> Dict[str, Any]:
     """初始化会话状态。"""
     return {
         "client": None,
-        "history": [],            # [{"Role": "...", "Content": "..."}]
+        "history": new_history(default_max_turns),  # {"Role": "...", "Content": "..."}，不含 system
+        "system_msg_obj": None,   # 预构建的 system 消息（models.Message）
         "started_at": None,
         "model": None,
         "persona_file": [],       # 记录使用的人设文件列表
         "saved": False,
+        "save_future": None,      # 最近一次后台保存（见 save_dialogue）
+        "log_buffer": io.BytesIO(),   # 增量累积的日志正文（UTF-8），保存时无需遍历 history
+        "log_count": 0,
+        "busy": False,            # 是否有回复正在生成（见 chat_reply）
     }
 
+# 仅用于 busy 标记的检查与设置（State 会被 deepcopy，不能直接放锁）
+_session_lock = threading.Lock()
+BUSY_MSG = "【错误】上一条消息仍在生成中，请稍候再发送"
+
+def append_log(state: Dict[str, Any], msg: Dict[str, str]) -> None:
+    """把一条消息追加到会话日志缓冲区。"""
+    state["log_buffer"].write(format_log_entry(state["log_count"], msg).encode("utf-8"))
+    state["log_count"] += 1
+
 def start_session(model_name: str, persona_rel_paths: list[str] | None,
                   temperature: float, max_tokens: int):
     """
     点击“开始会话”：
-    - 初始化client
+    - 获取共享client
     - 合并多个人设XML并作为 system 注入
     - 清空 UI 聊天框，返回欢迎语与 state
     """
     state = init_state()
     try:
-        client = make_client()
+        client = get_shared_client()
     except Exception as e:
         return gr.update(value=f"【错误】SDK初始化失败：{e}"), [], state
 
-    history = []
     try:
         system_xml = merge_personas(persona_rel_paths, prompts_dir)
-        if system_xml.strip():
-            history.append({"Role": "system", "Content": system_xml})
     except Exception as e:
         return gr.update(value=f"【错误】读取/合并人设失败：{e}"), [], state
 
     state["client"] = client
-    state["history"] = history
+    state["history"] = new_history(default_max_turns)
     state["started_at"] = datetime.now()
     state["model"] = model_name
     state["persona_file"] = persona_rel_paths or []
     state["saved"] = False
+    if system_xml.strip():
+        # system 内容在会话内不变，只构建一次
+        state["system_msg_obj"] = _to_message({"Role": "system", "Content": system_xml})
+        append_log(state, {"Role": "system", "Content": system_xml})
 
     welcome = "会话已开始。现在可以在下方输入框对话。"
     return welcome, [], state
 
 def chat_reply(user_message: str, chat_history_ui: List[List[str]],
-               state: Dict[str, Any], temperature: float, max_tokens: int):
+               state: Dict[str, Any], temperature: float, max_tokens: int,
+               max_turns: int = default_max_turns):
     """
-    把用户消息写入 Hunyuan 历史，调用模型，写回助手消息。
-    返回：(错误文本或None, 更新后的UI聊天记录, 更新后的state)
+    把用户消息写入 Hunyuan 历史，流式调用模型，写回助手消息。
+    历史按 max_turns 轮做滑动窗口截断，避免每轮请求的上下文无限增长。
+    逐步 yield：(错误文本或None, 更新后的UI聊天记录, 更新后的state)
     """
     if not state or not state.get("client"):
-        return "【错误】请先点击“开始会话”", chat_history_ui, state
+        yield "【错误】请先点击“开始会话”", chat_history_ui, state
+        return
+
+    # 同一会话同一时间只处理一条消息（并发放开后，重复回车/点击会并行进入）
+    # 只在锁内检查并设置标记，yield 前必须释放锁
+    with _session_lock:
+        busy = state.get("busy")
+        if not busy:
+            state["busy"] = True
+    if busy:
+        yield BUSY_MSG, chat_history_ui, state
+        return
+    try:
+        yield from _chat_turn(user_message, chat_history_ui, state, temperature, max_tokens, max_turns)
+    finally:
+        state["busy"] = False
 
+def _chat_turn(user_message: str, chat_history_ui: List[List[str]],
+               state: Dict[str, Any], temperature: float, max_tokens: int,
+               max_turns: int):
     client = state["client"]
     model_name = state["model"]
     history = state["history"]
+    if history.maxlen != 2 * int(max_turns) + 1:
+        # 窗口大小被调整：按新窗口重建（保留最近的完整轮次）
+        history = state["history"] = new_history(max_turns, history)
 
     # 追加用户消息
     history.append({"Role": "user", "Content": user_message})
 
+    assistant_out = ""
     try:
-        assistant_out = call_hunyuan_chat(
+        for assistant_out in call_hunyuan_chat(
             client=client,
             model_name=model_name,
             messages=history,
             temperature=temperature,
-            max_tokens=max_tokens
-        )
-    except TencentCloudSDKException as e:
-        # 回滚用户这条，避免污染上下文
-        history.pop()
-        return f"【SDK错误】{e}", chat_history_ui, state
+            max_tokens=max_tokens,
+            system_msg=state.get("system_msg_obj"),
+        ):
+            # 流式刷新UI（此时尚未写回历史）
+            yield None, chat_history_ui + [[user_message, assistant_out]], state
+        if not assistant_out:
+            raise RuntimeError("模型未返回任何内容")
     except Exception as e:
+        # 回滚用户这条，避免污染上下文
         history.pop()
-        return f"【错误】{e}", chat_history_ui, state
+        if _is_sdk_error(e):
+            yield f"【SDK错误】{e}", chat_history_ui, state
+        else:
+            yield f"【错误】{e}", chat_history_ui, state
+        return
 
     # 写回历史
+    # 超出窗口的旧消息由 deque 自动淘汰（日志缓冲区仍保留完整对话）
     history.append({"Role": "assistant", "Content": assistant_out})
-    state["history"] = history
+    append_log(state, history[-2])
+    append_log(state, history[-1])
 
     # 更新UI
     chat_history_ui = chat_history_ui + [[user_message, assistant_out]]
-    return None, chat_history_ui, state
+    yield None, chat_history_ui, state
 
-def on_send(user_message, chatbot, state, temperature, max_tokens):
+def on_send(user_message, chatbot, state, temperature, max_tokens, max_turns):
     """
-    发送按钮/回车 的回调：
+    发送按钮/回车 的回调（生成器，流式刷新）：
     - 传递到 chat_reply
-    - 返回：清空输入框、更新后的chatbot、state
+    - 逐步返回：清空输入框、更新后的chatbot、state
+    - 上一条仍在生成而被拒绝时，保留输入框内容以便稍后重发
     """
     chatbot = chatbot or []
-    err, updated_chat, state = chat_reply(
-        user_message, chatbot, state, temperature, max_tokens
-    )
-    if err:
-        updated_chat = chatbot + [[user_message, err]]
-    return "", updated_chat, state
+    for err, updated_chat, state in chat_reply(
+        user_message, chatbot, state, temperature, max_tokens, max_turns
+    ):
+        if err:
+            updated_chat = chatbot + [[user_message, err]]
+        yield (user_message if err == BUSY_MSG else ""), updated_chat, state
 
 def end_and_save(state: Dict[str, Any]):
     """
     点击“结束并保存”：
-    - 保存整个 history 到 logs/
+    - 保存整段会话日志到 logs/
     """
-    if not state or not state.get("history"):
+    if not state or not state.get("log_count"):
         return "当前没有会话内容可保存。"
 
     if state.get("saved"):
-        return "本次会话已保存，无需重复保存。"
+        return f"本次会话已保存到：{state['save_future'].result().resolve()}"
+
+    pending = state.get("save_future")
+    if pending is not None and not pending.done():
+        return "日志正在后台写入，请稍候。"
+    # 上次后台写入失败时，提示原因并重新提交
+    prev_err = pending.exception() if pending is not None else None
+    retry_note = f"上次保存失败：{prev_err}；" if prev_err else ""
 
     try:
-        save_path = save_dialogue(
-            history=state["history"],
+        save_path, future = save_dialogue(
+            log_body=state["log_buffer"].getvalue(),
             model_name=state.get("model") or "unknown",
             persona_file=state.get("persona_file"),
             started_at=state.get("started_at") or datetime.now(),
             ended_at=datetime.now(),
         )
-        state["saved"] = True
-        return f"已保存到：{save_path.resolve()}"
     except Exception as e:
         return f"保存失败：{e}"
 
+    # 不等待写盘：写盘成功后才标记已保存；失败时保持未保存，再次点击可重试
+    def _mark_saved(f: Future):
+        if f.exception() is None:
+            state["saved"] = True
+
+    state["save_future"] = future
+    future.add_done_callback(_mark_saved)
+    return f"{retry_note}已提交保存，正在后台写入：{save_path.resolve()}（再次点击可查看结果）"
+
 def refresh_personas():
-    """重新扫描 prompts/ 下的人设XML文件（多选）。"""
-    files = scan_personas(prompts_dir)
+    """刷新 prompts/ 下的人设XML文件列表（多选），并清空人设内容与合并结果缓存。"""
+    _read_cached.cache_clear()
+    _system_intern.clear()
+    files = list_personas()
     if not files:
         return gr.update(choices=[], value=[]), "未在 prompts/ 下发现 .xml 文件"
     # 默认不选；也可改为 value=[files[0]]
@@ -288,8 +637,11 @@ def refresh_personas():
 
 # ===================== 构建 UI =====================
 def build_ui():
-    model_options = load_models_from_file(model_list_path)
-    persona_files = scan_personas(prompts_dir)
+    # 模型列表与人设列表互不依赖，并行加载
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        models_future = ex.submit(load_models_from_file, model_list_path)
+        personas_future = ex.submit(list_personas)
+        model_options, persona_files = models_future.result(), personas_future.result()
 
     with gr.Blocks(title="Goblin Panel (Hunyuan)") as demo:
         gr.Markdown("## Goblin 面板：选择模型 + 多个人设（合并为System）+ 对话 + 自动保存")
@@ -310,6 +662,7 @@ def build_ui():
         with gr.Row():
             temperature = gr.Slider(0.0, 2.0, value=default_temperature, step=0.05, label="温度（Temperature）")
             max_tokens = gr.Slider(64, 4096, value=default_max_tokens, step=64, label="最大输出Tokens（MaxTokens）")
+            max_turns = gr.Slider(1, 32, value=default_max_turns, step=1, label="上下文轮数（MaxTurns）")
 
         start_msg = gr.Markdown("")
         with gr.Row():
@@ -349,13 +702,15 @@ def build_ui():
 
         send_btn.click(
             on_send,
-            inputs=[user_input, chatbot, state, temperature, max_tokens],
-            outputs=[user_input, chatbot, state]
+            inputs=[user_input, chatbot, state, temperature, max_tokens, max_turns],
+            outputs=[user_input, chatbot, state],
+            queue=True,
         )
         user_input.submit(
             on_send,
-            inputs=[user_input, chatbot, state, temperature, max_tokens],
-            outputs=[user_input, chatbot, state]
+            inputs=[user_input, chatbot, state, temperature, max_tokens, max_turns],
+            outputs=[user_input, chatbot, state],
+            queue=True,
         )
 
         clear_btn.click(lambda: [], inputs=None, outputs=chatbot)
@@ -379,6 +734,8 @@ def build_ui():
 if __name__ == "__main__":
     ensure_dir(prompts_dir)
     ensure_dir(log_dir)
+    watch_personas(prompts_dir)
     ui = build_ui()
     # 本机访问：默认 http://127.0.0.1:7860
-    ui.launch()
+    # 流式回调依赖队列把增量推送到浏览器；放开并发，避免多用户请求被串行化
+    ui.queue(default_concurrency_limit=concurrency_limit).launch()
@@ -1,15 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
-import json
 import types
 from pathlib import Path
+from collections import deque
 from datetime import datetime
 
-from tencentcloud.common import credential
-from tencentcloud.common.profile.client_profile import ClientProfile
-from tencentcloud.common.profile.http_profile import HttpProfile
-from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
-from tencentcloud.hunyuan.v20230901 import hunyuan_client, models
+import orjson
 
 
 # ====== 根据你的项目路径修改 ======
@@ -18,6 +14,7 @@ MODEL_NAME = "hunyuan-a13b"       # 可换：hunyuan-standard / hunyuan-pro
 MAX_TOKENS = 512
 TEMPERATURE = 0.7
 LOG_DIR = "logs"                  # 对话日志保存目录（会自动创建）
+MAX_TURNS = 8                     # 滑动窗口：保留最近 N 轮 user/assistant（system 不计）
 
 
 def load_system_xml(path: str) -> str:
@@ -28,6 +25,11 @@ def load_system_xml(path: str) -> str:
 
 
 def make_client():
+    from tencentcloud.common import credential
+    from tencentcloud.common.profile.client_profile import ClientProfile
+    from tencentcloud.common.profile.http_profile import HttpProfile
+    from tencentcloud.hunyuan.v20230901 import hunyuan_client
+
     # 从环境变量读取密钥：TENCENTCLOUD_SECRET_ID / TENCENTCLOUD_SECRET_KEY
     cred = credential.Credential(
         os.getenv("TENCENTCLOUD_SECRET_ID"),
@@ -42,8 +44,16 @@ def make_client():
     return hunyuan_client.HunyuanClient(cred, "", clientProfile)
 
 
+def _is_sdk_error(e: Exception) -> bool:
+    # SDK 延迟导入，处理异常时再取异常类型
+    from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentCloudSDKException
+    return isinstance(e, TencentCloudSDKException)
+
+
 def chat_once(client, messages):
     """调用一次 ChatCompletions，返回 assistant 文本。"""
+    from tencentcloud.hunyuan.v20230901 import models
+
     req = models.ChatCompletionsRequest()
 
     params = {
@@ -53,7 +63,7 @@ def chat_once(client, messages):
         "MaxTokens": MAX_TOKENS,
         # "Stream": True,  # 需要流式再打开
     }
-    req.from_json_string(json.dumps(params, ensure_ascii=False))
+    req.from_json_string(orjson.dumps(params).decode())
 
     resp = client.ChatCompletions(req)
 
@@ -62,7 +72,7 @@ def chat_once(client, messages):
         chunks = []
         for event in resp:
             try:
-                data = json.loads(event["Data"])
+                data = orjson.loads(event["data"])
                 delta = data.get("Choices", [{}])[0].get("Delta", {}).get("Content", "")
                 print(delta, end="", flush=True)
                 chunks.append(delta)
@@ -71,8 +81,8 @@ def chat_once(client, messages):
         print()
         return "".join(chunks)
     else:  # 非流式
-        data = json.loads(resp.to_json_string())
-        return data["Choices"][0]["Message"]["Content"]
+        # SDK 已把响应反序列化为模型对象，直接取字段，无需再经 JSON 往返
+        return resp.Choices[0].Message.Content
 
 
 def ensure_log_dir() -> Path:
@@ -123,7 +133,9 @@ def save_dialogue(history, model_name: str, xml_path: str,
 
 
 def main():
-    history = []  # 放在最外层，便于 finally 中访问
+    system_msg = None  # 放在最外层，便于 finally 中访问
+    # 滑动窗口：maxlen=2*MAX_TURNS+1，追加时自动淘汰最旧消息（system 单独保存，不受影响）
+    turns = deque(maxlen=2 * MAX_TURNS + 1)
     session_started_at = datetime.now()
     saved = False  # 防重复保存
 
@@ -134,10 +146,8 @@ def main():
         # 2) 初始化客户端
         client = make_client()
 
-        # 3) 初始化对话历史（第一条是 system）
-        history = [
-            {"Role": "system", "Content": system_xml}
-        ]
+        # 3) 初始化对话历史（system 固定为第一条）
+        system_msg = {"Role": "system", "Content": system_xml}
 
         print("Goblin chat ready. Type 'exit' to quit.\n")
         while True:
@@ -152,37 +162,39 @@ def main():
                 break
 
             # 追加用户发言
-            history.append({"Role": "user", "Content": user_inp})
+            turns.append({"Role": "user", "Content": user_inp})
 
             # 调用一次模型
             try:
-                assistant_out = chat_once(client, history)
-            except TencentCloudSDKException as e:
+                assistant_out = chat_once(client, [system_msg, *turns])
+            except Exception as e:
+                if not _is_sdk_error(e):
+                    raise
                 print(f"[SDK Error] {e}")
                 # 删除刚刚追加的用户消息，避免把失败轮写进上下文
-                history.pop()
+                turns.pop()
                 continue
 
             # 打印并写回上下文
             print(f"Goblin: {assistant_out}\n")
-            history.append({"Role": "assistant", "Content": assistant_out})
-
-            # 可选：滑动窗口，避免上下文过长（保留最近8轮 user/assistant，对 system 不动）
-            MAX_TURNS = 8
-            non_sys = [m for m in history if m["Role"] != "system"]
-            if len(non_sys) > 2 * MAX_TURNS:
-                history = [history[0]] + non_sys[-2 * MAX_TURNS:]
+            turns.append({"Role": "assistant", "Content": assistant_out})
 
     except FileNotFoundError as e:
         print(e)
-    except TencentCloudSDKException as err:
+    except Exception as err:
+        if not _is_sdk_error(err):
+            raise
         print(err)
     finally:
         # 退出时自动保存
-        if history:
+        if system_msg:
+            # 窗口满时首条可能是被淘汰轮次的 assistant，保存前去掉，使日志从完整的一轮开始
+            saved_turns = list(turns)
+            if saved_turns and saved_turns[0]["Role"] == "assistant":
+                saved_turns = saved_turns[1:]
             try:
                 save_path = save_dialogue(
-                    history=history,
+                    history=[system_msg, *saved_turns],
                     model_name=MODEL_NAME,
                     xml_path=XML_PATH,
                     started_at=session_started_at,